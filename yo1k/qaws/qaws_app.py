@@ -1,18 +1,40 @@
 import atexit
-import json
-import urllib.request
+import os
+import random
+import threading
+import time
 from abc import ABC, abstractmethod
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from operator import itemgetter
 from typing import (Any, Callable, Generic, MutableSequence, NamedTuple, Optional, Sequence,
                     TypeVar, Union)
 
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
 from flask import Flask, abort, current_app, g, request
-from psycopg import Connection
+from psycopg import Connection, adapters
+from psycopg.conninfo import make_conninfo
+from psycopg.types.array import ListBinaryDumper, ListDumper
 from psycopg_pool import ConnectionPool
 
 T_co = TypeVar("T_co", covariant=True)
 JSONType = dict[str, Any]
 
+# psycopg has no dumper for array.array; it iterates like a list, so dump it as one.
+adapters.register_dumper(array, ListDumper)
+adapters.register_dumper(array, ListBinaryDumper)
+
+_CONNINFO = make_conninfo(
+        dbname=os.environ.get("POSTGRES_NAME", "postgres"),
+        user=os.environ.get("POSTGRES_USER", "postgres"),
+        password=os.environ.get("POSTGRES_PASSWORD", "postgres"),
+        host=os.environ.get("POSTGRES_HOST", "db"),
+        port=os.environ.get("POSTGRES_PORT", "5432"))
+
 
 class PreparedQuestions(NamedTuple):
     id: MutableSequence[int]
@@ -21,11 +43,18 @@ class PreparedQuestions(NamedTuple):
     created_at: MutableSequence[datetime]
 
 
+class UpstreamUnavailableError(Exception):
+    pass
+
+
 class QuestionService(ABC, Generic[T_co]):
     @abstractmethod
     def get_questions(self, num: int) -> T_co:
         pass
 
+    def prefetch(self, num: int) -> None:
+        pass
+
 
 class StorageService(ABC):
     @abstractmethod
@@ -45,33 +74,90 @@ class TransactionManager(ABC):
         pass
 
 
-class JSONQuestionService(QuestionService[Sequence[JSONType]]):
+class JSONQuestionService(QuestionService[bytes]):
+    __BREAKER_FAILURES = 5
+    __BREAKER_RESET_TIMEOUT = 30.0
+
     def __init__(self, url: str = "https://jservice.io/api/random?count=") -> None:
         self.__url: str = url
-
-    def get_questions(self, num: int) -> Sequence[JSONType]:
-        with urllib.request.urlopen(url=f"{self.__url}{num}") as response:
-            questions: Sequence[JSONType] = json.loads(response.read())
-            return questions
+        self.__session = requests.Session()
+        self.__session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+        atexit.register(self.__session.close)
+        self.__failures: int = 0
+        self.__opened_at: float = 0.0
+        self.__breaker_lock = threading.Lock()
+
+    def get_questions(self, num: int) -> bytes:
+        with self.__breaker_lock:
+            breaker_open = (
+                    self.__failures >= JSONQuestionService.__BREAKER_FAILURES
+                    and time.monotonic() - self.__opened_at
+                    < JSONQuestionService.__BREAKER_RESET_TIMEOUT)
+        if breaker_open:
+            raise UpstreamUnavailableError("jservice circuit breaker is open")
+        try:
+            response = self.__session.get(url=f"{self.__url}{num}", timeout=5.0)
+            response.raise_for_status()
+        except requests.RequestException as exc:
+            with self.__breaker_lock:
+                self.__failures += 1
+                self.__opened_at = time.monotonic()
+            raise UpstreamUnavailableError(f"jservice request failed: num={num}") from exc
+        with self.__breaker_lock:
+            self.__failures = 0
+        raw_questions: bytes = response.content
+        return raw_questions
 
 
 class DefaultQuestionService(QuestionService[PreparedQuestions]):
-    def __init__(self, delegate: QuestionService[Sequence[JSONType]]):
-        self.__delegate: QuestionService[Sequence[JSONType]] = delegate
+    __OVERFETCH_FACTOR = 2
+    __OVERFETCH_FLOOR = 50
+    __COLUMNS = itemgetter("id", "question", "answer", "created_at")
+
+    def __init__(self, delegate: QuestionService[bytes]):
+        self.__delegate: QuestionService[bytes] = delegate
+        self.__cache: deque[JSONType] = deque()
+        self.__cache_lock = threading.Lock()
 
     def get_questions(self, num: int) -> PreparedQuestions:
-        return DefaultQuestionService.__prepare_questions(
-                self.__delegate.get_questions(num))
+        with self.__cache_lock:
+            questions = [self.__cache.popleft() for _ in range(min(num, len(self.__cache)))]
+        missing = num - len(questions)
+        if missing > 0:
+            fetch_num = max(
+                    missing * DefaultQuestionService.__OVERFETCH_FACTOR,
+                    DefaultQuestionService.__OVERFETCH_FLOOR)
+            fetched: Sequence[JSONType] = orjson.loads(self.__delegate.get_questions(fetch_num))
+            questions.extend(fetched[:missing])
+            with self.__cache_lock:
+                self.__cache.extend(fetched[missing:])
+        return DefaultQuestionService.__prepare_questions(questions)
+
+    def prefetch(self, num: int) -> None:
+        with self.__cache_lock:
+            missing = num - len(self.__cache)
+        if missing > 0:
+            fetch_num = max(
+                    missing * DefaultQuestionService.__OVERFETCH_FACTOR,
+                    DefaultQuestionService.__OVERFETCH_FLOOR)
+            fetched: Sequence[JSONType] = orjson.loads(self.__delegate.get_questions(fetch_num))
+            with self.__cache_lock:
+                self.__cache.extend(fetched)
 
     @staticmethod
     def __prepare_questions(questions: Sequence[JSONType]) -> PreparedQuestions:
-        prep_questions = PreparedQuestions([], [], [], [])
+        uniq_questions: dict[int, JSONType] = {}
         for question in questions:
-            prep_questions.id.append(question["id"])
-            prep_questions.question.append(question["question"])
-            prep_questions.answer.append(question["answer"])
-            prep_questions.created_at.append(question["created_at"])
-        return prep_questions
+            uniq_questions.setdefault(question["id"], question)
+        if not uniq_questions:
+            return PreparedQuestions(array("q"), [], [], [])
+        ids, texts, answers, created_ats = zip(
+                *map(DefaultQuestionService.__COLUMNS, uniq_questions.values()))
+        return PreparedQuestions(
+                array("q", ids),
+                list(texts),
+                list(answers),
+                [datetime.fromisoformat(ts.replace("Z", "+00:00")) for ts in created_ats])
 
 
 class DefaultTransactionManager(TransactionManager):
@@ -84,28 +170,58 @@ class DefaultTransactionManager(TransactionManager):
 
 
 class PgStorageService(StorageService):
+    __COPY_THRESHOLD = 500
+
     def insert_uniq_questions(self, conn: Connection[tuple[Any]], questions: PreparedQuestions) -> \
             int:
-        with conn.cursor() as cur:
+        if len(questions.id) >= PgStorageService.__COPY_THRESHOLD:
+            return PgStorageService.__copy_questions(conn, questions)
+        with conn.cursor(binary=True) as cur:
             cur.execute(
                     """
-                    WITH inserted AS (
-                        INSERT INTO questions
-                        (SELECT * FROM unnest(
-                                %s::int[],
-                                %s::text[],
-                                %s::text[],
-                                %s::timestamptz[]))
-                        ON CONFLICT (id) DO NOTHING
-                        RETURNING id)
-                    SELECT COUNT(*) FROM inserted;""",
+                    INSERT INTO questions
+                    (SELECT * FROM unnest(
+                            %s::int[],
+                            %s::text[],
+                            %s::text[],
+                            %s::timestamptz[]))
+                    ON CONFLICT (id) DO NOTHING;""",
                     questions)
-            returning: list[tuple[Any]] = cur.fetchall()
-            inserted_count: int = returning[0][0]
+            inserted_count: int = cur.rowcount
+            return inserted_count
+
+    @staticmethod
+    def __copy_questions(conn: Connection[tuple[Any]], questions: PreparedQuestions) -> int:
+        with conn.cursor(binary=True) as cur:
+            cur.execute(
+                    """
+                    CREATE TEMP TABLE IF NOT EXISTS questions_staging
+                    (LIKE questions) ON COMMIT DROP;""")
+            with cur.copy(
+                    "COPY questions_staging (id, question, answer, created_at) "
+                    "FROM STDIN (FORMAT BINARY);") as copy:
+                copy.set_types(["int4", "text", "text", "timestamptz"])
+                for row in zip(
+                        questions.id, questions.question, questions.answer,
+                        questions.created_at):
+                    copy.write_row(row)
+            cur.execute(
+                    """
+                    INSERT INTO questions
+                    SELECT * FROM questions_staging
+                    ON CONFLICT (id) DO NOTHING;""")
+            inserted_count: int = cur.rowcount
+            cur.execute("TRUNCATE questions_staging;")
             return inserted_count
 
 
 class QAWS:
+    __MAX_ATTEMPTS = 4
+    __RETRY_DEADLINE = 2.0
+    __PREFETCH_NUM = 8
+    __BACKOFF_BASE = 0.05
+    __BACKOFF_CAP = 2.0
+
     def __init__(
             self,
             tx_manager: TransactionManager,
@@ -114,44 +230,62 @@ class QAWS:
         self.tx_manager: TransactionManager = tx_manager
         self.db_service: StorageService = db_service
         self.questions_service: QuestionService[PreparedQuestions] = questions_service
+        self.__prefetch_executor = ThreadPoolExecutor(max_workers=4)
 
     def request_questions(self) -> Union[str, dict[None, None]]:
-        questions_num: int = request.get_json().get('questions_num')  # type: ignore
-        assert isinstance(questions_num, int) and questions_num >= 0, \
-            f"questions_num={questions_num}"
+        try:
+            payload: Any = orjson.loads(request.get_data(cache=False))
+        except orjson.JSONDecodeError:
+            abort(400)
+        if not isinstance(payload, dict):
+            abort(400)
+        questions_num = payload.get('questions_num')
+        if not isinstance(questions_num, int) or questions_num < 0:
+            abort(400)
         if questions_num == 0:
             return {}
         else:
             questions = self.questions_service.get_questions(questions_num)
-            retries: int = 100
-            while retries > 0:
-                retries -= 1
+            deadline: float = time.monotonic() + QAWS.__RETRY_DEADLINE
+            attempts: int = 0
+            while attempts < QAWS.__MAX_ATTEMPTS and time.monotonic() < deadline:
+                attempts += 1
+                prefetch = self.__prefetch_executor.submit(
+                        self.questions_service.prefetch, QAWS.__PREFETCH_NUM)
                 inserted_questions_num = self.tx_manager.do_in_default_tx(
                         func=self.db_service.insert_uniq_questions,
                         questions=questions)
                 fail_uniq_num = questions_num - inserted_questions_num
                 if fail_uniq_num:
+                    time.sleep(
+                            min(QAWS.__BACKOFF_CAP, QAWS.__BACKOFF_BASE * 2 ** attempts)
+                            * random.uniform(0.5, 1.5))
+                    prefetch.result()
                     questions = self.questions_service.get_questions(fail_uniq_num)
                     questions_num = fail_uniq_num
                 else:
                     return questions.question[-1]
-            abort(500)
+            abort(503)
 
 
 def init_schema(conn: Connection[tuple[Any]]) -> None:
     with conn.cursor() as cur:
-        with current_app.open_resource('schema.sql') as schema:
-            cur.execute(schema.read())
+        cur.execute(current_app.config['SCHEMA_SQL'])
+
+
+def configure_conn(conn: Connection[tuple[Any]]) -> None:
+    conn.prepare_threshold = 0
 
 
 def create_app() -> Flask:
     app = Flask(__name__)
+    with app.open_resource('schema.sql') as schema:
+        app.config['SCHEMA_SQL'] = schema.read()
     conn_pool = ConnectionPool(
-            conninfo="dbname='postgres'"
-                     "user='postgres'"
-                     "password='postgres'"
-                     "host='db'"
-                     "port='5432'",
+            conninfo=_CONNINFO,
+            min_size=5,
+            max_size=25,
+            configure=configure_conn,
             open=False)
     tx_manager = DefaultTransactionManager()
     db_service = PgStorageService()
@@ -176,6 +310,11 @@ def create_app() -> Flask:
             conn.commit()
             conn_pool.putconn(conn)
 
+    def upstream_unavailable(  # pylint: disable=C0103, W0613
+            e: UpstreamUnavailableError) -> tuple[str, int]:
+        return "", 503
+
+    app.register_error_handler(UpstreamUnavailableError, upstream_unavailable)
     app.before_request(get_conn)
     app.add_url_rule(
             rule="/",